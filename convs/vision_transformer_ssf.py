@@ -388,9 +388,9 @@ def init_ssf_scale_shift(dim):
 def ssf_ada(x, scale, shift):
     assert scale.shape == shift.shape
     if x.shape[-1] == scale.shape[0]:
-        return x * scale + shift
+        return torch.addcmul(shift, x, scale)
     elif x.shape[1] == scale.shape[0]:
-        return x * scale.view(1, -1, 1, 1) + shift.view(1, -1, 1, 1)
+        return torch.addcmul(shift.view(1, -1, 1, 1), x, scale.view(1, -1, 1, 1))
     else:
         raise ValueError('the input tensor shape does not match the shape of the scale factor.')
 
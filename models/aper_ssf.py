@@ -1,26 +1,33 @@
 import logging
 import numpy as np
 import torch
+import torch.distributed as dist
 from torch import nn
-from torch.serialization import load
 from tqdm import tqdm
 from torch import optim
 from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from utils.inc_net import (
-    IncrementalNet,
     SimpleCosineIncrementalNet,
     MultiBranchCosineIncrementalNet,
     SimpleVitNet,
 )
 from models.base import BaseLearner
-from utils.toolkit import target2onehot, tensor2numpy
+from utils.toolkit import is_main_process
 
 # tune the model at first session with ssf, and then conduct simplecil.
 
 num_workers = 8
 
 
+def train_step(network, inputs, targets):
+    logits = network(inputs)["logits"]
+    loss = F.cross_entropy(logits, targets)
+    return loss, logits
+
+
 class Learner(BaseLearner):
     def __init__(self, args):
         super().__init__(args)
@@ -30,13 +37,23 @@ class Learner(BaseLearner):
             self._network = SimpleCosineIncrementalNet(args, True)
             self.batch_size = 128
             self.init_lr = args.get("init_lr", 0.01)
+            # NHWC lets cuDNN pick tensor-core conv kernels
+            self.memory_format = torch.channels_last
         else:
             self._network = SimpleVitNet(args, True)
             self.batch_size = args["batch_size"]
             self.init_lr = args["init_lr"]
+            self.memory_format = torch.contiguous_format
 
         self.weight_decay = args.get("weight_decay", 0.0005)
         self.min_lr = args.get("min_lr", 1e-8)
+        # mixed precision: bf16 where supported, otherwise fp16 with loss scaling
+        self.use_amp = self._device.type == "cuda" and args.get("amp", True)
+        self.amp_dtype = (
+            torch.bfloat16
+            if self.use_amp and torch.cuda.is_bf16_supported()
+            else torch.float16
+        )
         self.args = args
 
     def after_task(self):
@@ -45,27 +62,29 @@ class Learner(BaseLearner):
     def replace_fc(self, trainloader, model, args):
         # replace fc.weight with the embedding average of train data
         model = model.eval()
-        embedding_list = []
-        label_list = []
+        # accumulate per-class sums batch by batch, so no N x D embedding
+        # matrix is ever materialised; prototypes are sums / counts
+        num_classes, feature_dim = self._network.fc.weight.shape
+        sums = torch.zeros(num_classes, feature_dim, device=self._device)
+        counts = torch.zeros(num_classes, device=self._device)
         with torch.no_grad():
             for i, batch in enumerate(trainloader):
                 (_, data, label) = batch
-                data = data.cuda()
-                label = label.cuda()
-                embedding = model(data)["features"]
-                embedding_list.append(embedding.cpu())
-                label_list.append(label.cpu())
-        embedding_list = torch.cat(embedding_list, dim=0)
-        label_list = torch.cat(label_list, dim=0)
-
-        class_list = np.unique(self.train_dataset.labels)
-        proto_list = []
-        for class_index in class_list:
-            # print('Replacing...',class_index)
-            data_index = (label_list == class_index).nonzero().squeeze(-1)
-            embedding = embedding_list[data_index]
-            proto = embedding.mean(0)
-            self._network.fc.weight.data[class_index] = proto
+                data = data.to(self._device, non_blocking=True).contiguous(
+                    memory_format=self.memory_format
+                )
+                label = label.to(self._device, non_blocking=True)
+                with self._autocast():
+                    embedding = model(data)["features"]
+                sums.index_add_(0, label, embedding.float())
+                counts.index_add_(0, label, torch.ones_like(label, dtype=torch.float))
+        protos = sums / counts.clamp_min(1).unsqueeze(1)
+
+        # classes of this session are exactly the rows with a non-zero count,
+        # so a single mask replaces the per-class index lookup
+        weight = self._network.fc.weight.data
+        present = (counts > 0).unsqueeze(1).to(weight.device)
+        weight.copy_(torch.where(present, protos.to(weight), weight))
         return model
 
     def incremental_train(self, data_manager):
@@ -85,20 +104,36 @@ class Learner(BaseLearner):
         )
         self.train_dataset = train_dataset
         self.data_manager = data_manager
+        train_sampler = (
+            DistributedSampler(train_dataset) if self.args.get("ddp", False) else None
+        )
         self.train_loader = DataLoader(
             train_dataset,
             batch_size=self.batch_size,
-            shuffle=True,
+            shuffle=train_sampler is None,
+            sampler=train_sampler,
             num_workers=num_workers,
+            # a fixed batch shape lets the compiled step replay one CUDA graph
+            drop_last=self._compiles_train_step()
+            and len(train_dataset) >= self.batch_size,
+            pin_memory=self._device.type == "cuda",
+            persistent_workers=True,
+            prefetch_factor=4,
         )
         test_dataset = data_manager.get_dataset(
             np.arange(0, self._total_classes), source="test", mode="test"
         )
+        # the test set is re-evaluated during first-session tuning and once more
+        # in eval_task; later sessions only read it once
+        reuse_test_loader = self._cur_task == 0 and is_main_process()
         self.test_loader = DataLoader(
             test_dataset,
             batch_size=self.batch_size,
             shuffle=False,
             num_workers=num_workers,
+            pin_memory=self._device.type == "cuda",
+            persistent_workers=reuse_test_loader,
+            prefetch_factor=4 if reuse_test_loader else 2,
         )
 
         train_dataset_for_protonet = data_manager.get_dataset(
@@ -111,6 +146,7 @@ class Learner(BaseLearner):
             batch_size=self.batch_size,
             shuffle=True,
             num_workers=num_workers,
+            pin_memory=self._device.type == "cuda",
         )
 
         if len(self._multiple_gpus) > 1:
@@ -123,7 +159,7 @@ class Learner(BaseLearner):
             self._network = self._network.module
 
     def _train(self, train_loader, test_loader, train_loader_for_protonet):
-        self._network.to(self._device)
+        self._network.to(self._device, memory_format=self.memory_format)
 
         if self._cur_task == 0:  # 第一次 调
             # Freeze the parameters for ViT.
@@ -146,80 +182,172 @@ class Learner(BaseLearner):
                             print(name)
                     print("freezing parameters finished!")
 
-            # show total parameters and trainable parameters
-            total_params = sum(p.numel() for p in self._network.parameters())
-            print(f"{total_params:,} total parameters.")
-            total_trainable_params = sum(
-                p.numel() for p in self._network.parameters() if p.requires_grad
-            )
-            print(f"{total_trainable_params:,} training parameters.")
-            if total_params != total_trainable_params:
-                for name, param in self._network.named_parameters():
-                    if param.requires_grad:
-                        print(name, param.numel())
+            # show total parameters and trainable parameters, in a single pass
+            total_params, total_trainable_params = 0, 0
+            trainable, trainable_names = [], []
+            for name, param in self._network.named_parameters():
+                total_params += param.numel()
+                if param.requires_grad:
+                    total_trainable_params += param.numel()
+                    trainable.append(param)
+                    trainable_names.append((name, param.numel()))
+            if is_main_process():
+                print(f"{total_params:,} total parameters.")
+                print(f"{total_trainable_params:,} training parameters.")
+                if total_params != total_trainable_params:
+                    for name, numel in trainable_names:
+                        print(name, numel)
 
+            # only hand trainable params to the optimizer, frozen ones get no state
             if self.args["optimizer"] == "sgd":
                 optimizer = optim.SGD(
-                    self._network.parameters(),
+                    trainable,
                     momentum=0.9,
                     lr=self.init_lr,
                     weight_decay=self.weight_decay,
                 )
             elif self.args["optimizer"] == "adam":
                 optimizer = optim.AdamW(
-                    self._network.parameters(),
+                    trainable,
                     lr=self.init_lr,
                     weight_decay=self.weight_decay,
                 )
             scheduler = optim.lr_scheduler.CosineAnnealingLR(
                 optimizer, T_max=self.args["tuned_epoch"], eta_min=self.min_lr
             )
+            network = self._network
+            if self.args.get("ddp", False):
+                # wrap after freezing so DDP only allreduces the trainable params
+                network = DistributedDataParallel(network, device_ids=[self._device])
             self._init_train(
-                train_loader, test_loader, optimizer, scheduler
+                train_loader, test_loader, optimizer, scheduler, network
             )  # STEP 2.1
-            self.construct_dual_branch_network()  # STEP 2.2
+            if self.args.get("dual_branch", True):
+                self.construct_dual_branch_network()  # STEP 2.2
         else:
             pass
 
         # 应该是：FC带着bacbone一起调，调完后把FC替换为NCM
-        self.replace_fc(train_loader_for_protonet, self._network, None)  # STEP 2.3
+        if is_main_process():
+            self.replace_fc(train_loader_for_protonet, self._network, None)  # STEP 2.3
+        if self.args.get("ddp", False):
+            # prototypes are computed on rank 0 and shared with the other ranks
+            dist.broadcast(self._network.fc.weight.data, src=0)
 
     def construct_dual_branch_network(self):
         network = MultiBranchCosineIncrementalNet(self.args, True)
         network.construct_dual_branch_network(self._network)  # concat
-        self._network = network.to(self._device)
+        self._network = network.to(self._device, memory_format=self.memory_format)
+
+    def _compiles_train_step(self):
+        # only the training step is compiled, replace_fc and the dual-branch
+        # network stay eager since their small graphs do not pay off. The
+        # DataParallel/DDP wrappers break fullgraph capture, so they stay eager too,
+        # and off CUDA there are no CUDA graphs to replay.
+        return (
+            self.args.get("compile", True)
+            and self._device.type == "cuda"
+            and hasattr(torch, "compile")
+            and len(self._multiple_gpus) == 1
+            and not self.args.get("ddp", False)
+        )
+
+    def _autocast(self):
+        return torch.autocast(
+            device_type=self._device.type, dtype=self.amp_dtype, enabled=self.use_amp
+        )
 
-    def _init_train(self, train_loader, test_loader, optimizer, scheduler):
-        prog_bar = tqdm(range(self.args["tuned_epoch"]))
+    def _forward_backward(self, step, network, inputs, targets, scaler):
+        if step is train_step:
+            inputs = inputs.to(self._device, non_blocking=True).contiguous(
+                memory_format=self.memory_format
+            )
+        else:
+            if self._static_inputs is None:
+                self._static_inputs = torch.empty(
+                    inputs.shape,
+                    dtype=inputs.dtype,
+                    device=self._device,
+                    memory_format=self.memory_format,
+                )
+                # a fixed address lets CUDA graph replay read the buffer
+                # directly instead of copying it into its own input slot
+                torch._dynamo.mark_static_address(self._static_inputs)
+            self._static_inputs.copy_(inputs, non_blocking=True)
+            inputs = self._static_inputs
+        with self._autocast():
+            loss, logits = step(network, inputs, targets)
+        scaler.scale(loss).backward()
+        return loss, logits
+
+    def _init_train(self, train_loader, test_loader, optimizer, scheduler, network):
+        step = train_step
+        if self._compiles_train_step():
+            step = torch.compile(train_step, mode="reduce-overhead", fullgraph=True)
+        step_compiled = False
+        self._static_inputs = None
+        scaler = torch.cuda.amp.GradScaler(
+            enabled=self.use_amp and self.amp_dtype == torch.float16
+        )
+        eval_every = self.args.get("eval_every", 5)
+        test_acc = None
+        prog_bar = tqdm(range(self.args["tuned_epoch"]), disable=not is_main_process())
         for _, epoch in enumerate(prog_bar):
+            if isinstance(train_loader.sampler, DistributedSampler):
+                train_loader.sampler.set_epoch(epoch)
             self._network.train()
-            losses = 0.0
-            correct, total = 0, 0
+            # accumulate on device and sync once per epoch
+            losses = torch.zeros((), device=self._device)
+            correct = torch.zeros((), dtype=torch.long, device=self._device)
+            total = 0
             for i, (_, inputs, targets) in enumerate(train_loader):
-                inputs, targets = inputs.to(self._device), targets.to(self._device)
-                logits = self._network(inputs)["logits"]
-
-                loss = F.cross_entropy(logits, targets)
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                losses += loss.item()
+                targets = targets.to(self._device, non_blocking=True)
+                optimizer.zero_grad(set_to_none=True)
+                if step is train_step or step_compiled:
+                    loss, logits = self._forward_backward(
+                        step, network, inputs, targets, scaler
+                    )
+                else:
+                    # torch.compile is lazy: the forward and backward graphs are
+                    # captured on this first step, so fall back to eager if that fails
+                    try:
+                        loss, logits = self._forward_backward(
+                            step, network, inputs, targets, scaler
+                        )
+                        step_compiled = True
+                    except torch._dynamo.exc.TorchDynamoException as e:
+                        logging.warning(
+                            "Compiling the train step failed, falling back to eager: {}".format(e)
+                        )
+                        step = train_step
+                        optimizer.zero_grad(set_to_none=True)
+                        loss, logits = self._forward_backward(
+                            step, network, inputs, targets, scaler
+                        )
+                scaler.step(optimizer)
+                scaler.update()
+                losses += loss.detach()
 
                 _, preds = torch.max(logits, dim=1)
-                correct += preds.eq(targets.expand_as(preds)).cpu().sum()
+                correct += preds.eq(targets).sum()
                 total += len(targets)
 
             scheduler.step()
-            train_acc = np.around(tensor2numpy(correct) * 100 / total, decimals=2)
+            train_acc = np.around(correct.item() * 100 / total, decimals=2)
 
-            test_acc = self._compute_accuracy(self._network, test_loader)
-            info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {:.2f}".format(
+            # test accuracy is only for monitoring, so evaluate every few epochs
+            # and, under ddp, on rank 0 only
+            if is_main_process() and (
+                (epoch + 1) % eval_every == 0 or epoch == self.args["tuned_epoch"] - 1
+            ):
+                test_acc = self._compute_accuracy(self._network, test_loader)
+            info = "Task {}, Epoch {}/{} => Loss {:.3f}, Train_accy {:.2f}, Test_accy {}".format(
                 self._cur_task,
                 epoch + 1,
                 self.args["tuned_epoch"],
-                losses / len(train_loader),
+                losses.item() / len(train_loader),
                 train_acc,
-                test_acc,
+                "n/a" if test_acc is None else "{:.2f}".format(test_acc),
             )
             prog_bar.set_description(info)
 
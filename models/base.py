@@ -159,7 +159,7 @@ class BaseLearner(object):
         correct, total = 0, 0
         for i, (_, inputs, targets) in enumerate(loader):
             inputs = inputs.to(self._device)
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = model(inputs)["logits"]
             predicts = torch.max(outputs, dim=1)[1]
             correct += (predicts.cpu() == targets).sum()
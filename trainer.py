@@ -1,10 +1,12 @@
 import sys
 import logging
 import copy
+import datetime
 import torch
+import torch.distributed as dist
 from utils import factory
 from utils.data_manager import DataManager
-from utils.toolkit import count_parameters
+from utils.toolkit import count_parameters, is_main_process
 import os
 
 
@@ -20,12 +22,13 @@ def train(args):
 
 def _train(args):
 
+    _set_device(args)
     init_cls = 0 if args["init_cls"] == args["increment"] else args["init_cls"]
     logs_name = "logs/{}/{}/{}/{}".format(
         args["model_name"], args["dataset"], init_cls, args["increment"]
     )
 
-    if not os.path.exists(logs_name):
+    if is_main_process() and not os.path.exists(logs_name):
         os.makedirs(logs_name)
 
     logfilename = "logs/{}/{}/{}/{}/{}_{}_{}".format(
@@ -37,17 +40,20 @@ def _train(args):
         args["seed"],
         args["convnet_type"],
     )
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s [%(filename)s] => %(message)s",
-        handlers=[
-            logging.FileHandler(filename=logfilename + ".log"),
-            logging.StreamHandler(sys.stdout),
-        ],
-    )
+    if is_main_process():
+        logging.basicConfig(
+            level=logging.INFO,
+            format="%(asctime)s [%(filename)s] => %(message)s",
+            handlers=[
+                logging.FileHandler(filename=logfilename + ".log"),
+                logging.StreamHandler(sys.stdout),
+            ],
+        )
+    else:
+        # under ddp only rank 0 writes the log, the other ranks just train
+        logging.basicConfig(level=logging.WARNING)
 
     _set_random()
-    _set_device(args)
     print_args(args)
     data_manager = DataManager(
         args["dataset"],
@@ -68,6 +74,10 @@ def _train(args):
             "Trainable params: {}".format(count_parameters(model._network, True))
         )
         model.incremental_train(data_manager)
+        if not is_main_process():
+            # evaluation runs on rank 0 only
+            model.after_task()
+            continue
         cnn_accy, nme_accy = model.eval_task()
         model.after_task()
 
@@ -125,8 +135,27 @@ def _train(args):
                 )
             )
 
+    if dist.is_initialized():
+        # keep the other ranks alive until rank 0 finishes its last evaluation
+        dist.barrier()
+        dist.destroy_process_group()
+
 
 def _set_device(args):
+    if args.get("ddp", False):
+        # one process per GPU, launched with torchrun
+        if not dist.is_initialized():
+            # rank 0 evaluates and builds prototypes alone while the other ranks
+            # wait in the next collective, so allow for slow large benchmarks
+            dist.init_process_group(
+                "nccl",
+                timeout=datetime.timedelta(seconds=args.get("ddp_timeout", 7200)),
+            )
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        args["device"] = [torch.device("cuda:{}".format(local_rank))]
+        return
+
     device_type = args["device"]
     gpus = []
 
@@ -631,7 +631,7 @@ class SimpleVitNet(BaseNet):
     def forward(self, x):
         x = self.convnet(x)
         out = self.fc(x)
-        # out.update(x)
+        out.update({"features": x})
         return out
 
 
@@ -1,6 +1,7 @@
 import os
 import numpy as np
 import torch
+import torch.distributed as dist
 
 
 def count_parameters(model, trainable=False):
@@ -9,6 +10,11 @@ def count_parameters(model, trainable=False):
     return sum(p.numel() for p in model.parameters())
 
 
+def is_main_process():
+    # rank 0 under ddp, always true for single-process runs
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
 def tensor2numpy(x):
     return x.cpu().data.numpy() if x.is_cuda else x.data.numpy()
 